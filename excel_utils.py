@@ -1,13 +1,45 @@
 import pandas as pd
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
+from openpyxl.utils import get_column_letter, column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import from_excel, from_ISO8601, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
 from openpyxl.worksheet.table import Table, TableStyleInfo
 import numpy as np
 from typing import Dict, List, Any, Tuple, Optional
 import io
 import tempfile
 import os
+import posixpath
+import zipfile
+
+# 上传的xlsx不可信：与openpyxl一致，安装了defusedxml时用它防御实体扩展攻击，
+# 否则使用不解析外部实体的标准库解析器（不使用lxml默认解析器，旧版本会展开外部实体）
+try:
+    from defusedxml import ElementTree as xml_etree
+except ImportError:
+    import xml.etree.ElementTree as xml_etree
+
+# Markdown表格单元格转义表：一次translate完成竖线转义和换行清理
+_MD_TRANS = str.maketrans({"|": "\\|", "\n": " ", "\r": None})
+
+# 轻量分析只需要工作表前若干行
+_QUICK_SCAN_ROWS = 50
+
+# xlsx XML命名空间和标签
+_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_DOC_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_SHEET_DATA_TAG = _MAIN_NS + "sheetData"
+_ROW_TAG = _MAIN_NS + "row"
+_CELL_TAG = _MAIN_NS + "c"
+_VALUE_TAG = _MAIN_NS + "v"
+_TEXT_TAG = _MAIN_NS + "t"
+_RUN_TAG = _MAIN_NS + "r"
+_INLINE_STR_TAG = _MAIN_NS + "is"
+_MERGE_CELL_TAG = _MAIN_NS + "mergeCell"
+_DIMENSION_TAG = _MAIN_NS + "dimension"
 
 class SmartExcelAnalyzer:
     """智能Excel分析器 - 自动识别和处理各种Excel文件结构"""
@@ -1349,7 +1381,7 @@ class AdvancedExcelProcessor:
         display_df = df.head(display_rows).iloc[:, :display_cols]
         
         # 处理列名，确保不会太长
-        headers = ["#"] + [str(col)[:15] + "..." if len(str(col)) > 15 else str(col) for col in display_df.columns]
+        headers = ["#"] + [(str(col)[:15] + "..." if len(str(col)) > 15 else str(col)).translate(_MD_TRANS) for col in display_df.columns]
         markdown += "| " + " | ".join(headers) + " |\n"
         markdown += "| " + " | ".join(["---"] * len(headers)) + " |\n"
         
@@ -1361,7 +1393,7 @@ class AdvancedExcelProcessor:
                 # 限制单元格内容长度
                 if len(str_val) > 20:
                     str_val = str_val[:17] + "..."
-                row_data.append(str_val)
+                row_data.append(str_val.translate(_MD_TRANS))
             markdown += "| " + " | ".join(row_data) + " |\n"
         
         # 添加省略信息
@@ -1417,10 +1449,20 @@ class AdvancedExcelProcessor:
         if column not in df.columns:
             return False, f"列 '{column}' 不存在"
         
+        is_numeric = pd.api.types.is_numeric_dtype(df[column])
+        if not ((method in ("mean", "median") and is_numeric)
+                or method in ("mode", "forward", "backward")
+                or (method == "custom" and custom_value is not None)):
+            return False, f"不支持的填充方法: {method}"
+        
+        # 没有缺失值时无需计算填充值
+        if not df[column].isna().any():
+            return True, f"列 '{column}' 没有缺失值"
+        
         try:
-            if method == "mean" and pd.api.types.is_numeric_dtype(df[column]):
+            if method == "mean":
                 df[column].fillna(df[column].mean(), inplace=True)
-            elif method == "median" and pd.api.types.is_numeric_dtype(df[column]):
+            elif method == "median":
                 df[column].fillna(df[column].median(), inplace=True)
             elif method == "mode":
                 mode_value = df[column].mode().iloc[0] if not df[column].mode().empty else ""
@@ -1429,10 +1471,8 @@ class AdvancedExcelProcessor:
                 df[column].fillna(method='ffill', inplace=True)
             elif method == "backward":
                 df[column].fillna(method='bfill', inplace=True)
-            elif method == "custom" and custom_value is not None:
-                df[column].fillna(custom_value, inplace=True)
             else:
-                return False, f"不支持的填充方法: {method}"
+                df[column].fillna(custom_value, inplace=True)
             
             self.modified_data[sheet_name] = df
             return True, f"成功填充列 '{column}' 的缺失值"
@@ -1458,6 +1498,9 @@ class AdvancedExcelProcessor:
             summary_data = []
             for col in target_columns:
                 if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+                    # 全空列的统计量都是NaN，直接跳过
+                    if not df[col].notna().any():
+                        continue
                     stats = {
                         '列名': col,
                         '计数': df[col].count(),
@@ -1580,14 +1623,21 @@ class DataAnalyzer:
         """获取缺失值报告"""
         missing_data = []
         try:
+            # 一次性统计各列缺失情况，无缺失的列直接使用常量
+            has_missing = df.isna().any()
             for col in df.columns:
                 try:
-                    missing_count = df[col].isnull().sum()
-                    missing_percent = (missing_count / len(df)) * 100 if len(df) > 0 else 0
+                    if not has_missing[col]:
+                        missing_count = 0
+                        missing_percent_str = "0.00%"
+                    else:
+                        missing_count = df[col].isnull().sum()
+                        missing_percent = (missing_count / len(df)) * 100 if len(df) > 0 else 0
+                        missing_percent_str = f"{missing_percent:.2f}%"
                     missing_data.append({
                         '列名': str(col),
                         '缺失数量': missing_count,
-                        '缺失百分比': f"{missing_percent:.2f}%",
+                        '缺失百分比': missing_percent_str,
                         '数据类型': str(df[col].dtype) if col in df.columns else "未知"
                     })
                 except Exception as e:
@@ -1611,6 +1661,11 @@ class DataAnalyzer:
             
             for col in numeric_columns:
                 try:
+                    # 全空列不可能存在异常值
+                    if not df[col].notna().any():
+                        outliers[col] = []
+                        continue
+                    
                     if method == "iqr":
                         Q1 = df[col].quantile(0.25)
                         Q3 = df[col].quantile(0.75)
@@ -1642,30 +1697,234 @@ class DataAnalyzer:
         
         return outliers 
 
+class StreamedCell:
+    """流式读取的单元格，只保留值"""
+    
+    __slots__ = ('value',)
+    
+    def __init__(self, value=None):
+        self.value = value
+
+class StreamedSheet:
+    """流式读取的工作表快照，提供轻量分析所需的最小worksheet接口"""
+    
+    def __init__(self, rows: Dict[int, Dict[int, Any]], merged_ranges: List[CellRange], max_row: int, max_column: int):
+        self.rows = rows
+        self.merged_cells = MultiCellRange(merged_ranges)
+        self.max_row = max_row
+        self.max_column = max_column
+    
+    def cell(self, row: int, column: int) -> StreamedCell:
+        """获取单元格（超出已读取范围的单元格视为空）"""
+        return StreamedCell(self.rows.get(row, {}).get(column))
+
+class XlsxStreamReader:
+    """直接从xlsx压缩包流式解析XML，跳过openpyxl对象模型，只读取值、合并单元格和尺寸"""
+    
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.sheet_paths = {}
+        self.shared_strings = []
+        self.date_styles = set()
+        self.epoch = CALENDAR_WINDOWS_1900
+        
+        with zipfile.ZipFile(file_path) as archive:
+            self._load_workbook_index(archive)
+            self._load_shared_strings(archive)
+            self._load_date_styles(archive)
+    
+    @property
+    def sheet_names(self) -> List[str]:
+        """工作表名称（按工作簿顺序）"""
+        return list(self.sheet_paths)
+    
+    def read_sheet(self, sheet_name: str, max_rows: int = _QUICK_SCAN_ROWS) -> StreamedSheet:
+        """读取工作表前max_rows行的值以及全部合并单元格"""
+        rows = {}
+        merged_ranges = []
+        max_row = max_column = 0
+        
+        with zipfile.ZipFile(self.file_path) as archive:
+            sheet_path = self.sheet_paths[sheet_name]
+            if sheet_path not in archive.namelist():
+                return StreamedSheet(rows, merged_ranges, 0, 0)
+            
+            with archive.open(sheet_path) as sheet_file:
+                row_num = 0
+                sheet_data = None
+                for event, elem in xml_etree.iterparse(sheet_file, events=('start', 'end')):
+                    tag = elem.tag
+                    if event == 'start':
+                        if tag == _SHEET_DATA_TAG:
+                            sheet_data = elem
+                        continue
+                    if tag == _ROW_TAG:
+                        row_num = int(elem.get('r', row_num + 1))
+                        max_row = max(max_row, row_num)
+                        # 合并单元格位于sheetData之后，超出行数限制的行只记录行号
+                        if row_num <= max_rows:
+                            values = self._read_row_values(elem)
+                            if values:
+                                rows[row_num] = values
+                                max_column = max(max_column, max(values))
+                        # 从sheetData中移除已处理的行，解析后续内容时内存占用保持不变
+                        elem.clear()
+                        if sheet_data is not None:
+                            sheet_data.remove(elem)
+                    elif tag == _MERGE_CELL_TAG:
+                        merged_ranges.append(CellRange(elem.get('ref')))
+                    elif tag == _DIMENSION_TAG:
+                        try:
+                            _, _, dim_col, dim_row = range_boundaries(elem.get('ref'))
+                            max_row = max(max_row, dim_row or 0)
+                            max_column = max(max_column, dim_col or 0)
+                        except (TypeError, ValueError):
+                            pass
+        
+        return StreamedSheet(rows, merged_ranges, max_row, max_column)
+    
+    def _read_row_values(self, row_elem) -> Dict[int, Any]:
+        """读取一行中非空单元格的值"""
+        values = {}
+        col = 0
+        for cell_elem in row_elem.iter(_CELL_TAG):
+            ref = cell_elem.get('r')
+            col = column_index_from_string(ref.rstrip('0123456789')) if ref else col + 1
+            value = self._read_cell_value(cell_elem)
+            if value is not None:
+                values[col] = value
+        return values
+    
+    def _read_cell_value(self, cell_elem):
+        """按单元格类型解析值（与openpyxl的data_only读取结果一致）"""
+        cell_type = cell_elem.get('t', 'n')
+        
+        if cell_type == 'inlineStr':
+            inline = cell_elem.find(_INLINE_STR_TAG)
+            return self._extract_text(inline) if inline is not None else None
+        
+        value_elem = cell_elem.find(_VALUE_TAG)
+        if value_elem is None or value_elem.text is None:
+            return None
+        text = value_elem.text
+        
+        if cell_type == 's':
+            return self.shared_strings[int(text)]
+        if cell_type == 'b':
+            return text == '1'
+        if cell_type in ('str', 'e'):
+            return text
+        if cell_type == 'd':
+            return from_ISO8601(text)
+        
+        number = float(text) if any(ch in text for ch in '.eE') else int(text)
+        if int(cell_elem.get('s', 0)) in self.date_styles:
+            try:
+                return from_excel(number, self.epoch)
+            except (ValueError, OverflowError):
+                return number
+        return number
+    
+    def _load_workbook_index(self, archive: zipfile.ZipFile):
+        """读取工作表名称及其在压缩包中的路径"""
+        workbook = xml_etree.fromstring(archive.read('xl/workbook.xml'))
+        rels = xml_etree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target', '') for rel in rels.iter(_PKG_REL_NS + 'Relationship')}
+        
+        workbook_pr = workbook.find(_MAIN_NS + 'workbookPr')
+        if workbook_pr is not None and workbook_pr.get('date1904') in ('1', 'true'):
+            self.epoch = CALENDAR_MAC_1904
+        
+        for sheet in workbook.iter(_MAIN_NS + 'sheet'):
+            target = targets.get(sheet.get(_DOC_REL_NS + 'id'), '')
+            if target.startswith('/'):
+                sheet_path = target.lstrip('/')
+            else:
+                sheet_path = posixpath.normpath(posixpath.join('xl', target))
+            self.sheet_paths[sheet.get('name')] = sheet_path
+        
+        if not self.sheet_paths:
+            raise ValueError("未找到任何工作表")
+    
+    def _load_shared_strings(self, archive: zipfile.ZipFile):
+        """流式读取共享字符串表"""
+        if 'xl/sharedStrings.xml' not in archive.namelist():
+            return
+        
+        si_tag = _MAIN_NS + 'si'
+        with archive.open('xl/sharedStrings.xml') as strings_file:
+            for _, elem in xml_etree.iterparse(strings_file, events=('end',)):
+                if elem.tag == si_tag:
+                    self.shared_strings.append(self._extract_text(elem))
+                    elem.clear()
+    
+    def _load_date_styles(self, archive: zipfile.ZipFile):
+        """找出使用日期格式的单元格样式索引"""
+        if 'xl/styles.xml' not in archive.namelist():
+            return
+        
+        styles = xml_etree.fromstring(archive.read('xl/styles.xml'))
+        custom_formats = {
+            int(fmt.get('numFmtId')): fmt.get('formatCode')
+            for fmt in styles.iter(_MAIN_NS + 'numFmt')
+        }
+        
+        cell_xfs = styles.find(_MAIN_NS + 'cellXfs')
+        if cell_xfs is None:
+            return
+        
+        for index, xf in enumerate(cell_xfs.findall(_MAIN_NS + 'xf')):
+            fmt_id = int(xf.get('numFmtId', 0))
+            format_code = custom_formats.get(fmt_id) or BUILTIN_FORMATS.get(fmt_id)
+            if format_code and is_date_format(format_code):
+                self.date_styles.add(index)
+    
+    @staticmethod
+    def _extract_text(elem) -> str:
+        """提取<si>/<is>中的文本，忽略拼音注释"""
+        parts = []
+        for child in elem:
+            if child.tag == _TEXT_TAG:
+                parts.append(child.text or "")
+            elif child.tag == _RUN_TAG:
+                text_elem = child.find(_TEXT_TAG)
+                if text_elem is not None:
+                    parts.append(text_elem.text or "")
+        return "".join(parts)
+
 class LightweightExcelAnalyzer:
     """轻量级Excel分析器 - 专为AI智能分析tab设计，生成精简提示词"""
     
     def __init__(self):
         self.workbook = None
+        self.stream_reader = None
         self.analysis_cache = None
     
     def quick_analyze(self, file_path: str) -> Dict[str, Any]:
         """快速分析Excel文件，生成AI分析所需的核心信息"""
         try:
-            self.workbook = openpyxl.load_workbook(file_path, data_only=True)
+            # 优先直接流式解析xlsx的XML，失败时回退到openpyxl
+            self.workbook = None
+            try:
+                self.stream_reader = XlsxStreamReader(file_path)
+                sheet_names = self.stream_reader.sheet_names
+            except Exception:
+                self.stream_reader = None
+                self.workbook = openpyxl.load_workbook(file_path, data_only=True)
+                sheet_names = self.workbook.sheetnames
             
             analysis = {
                 'file_info': {
                     'filename': file_path.split('/')[-1],
-                    'sheet_count': len(self.workbook.sheetnames),
-                    'sheet_names': self.workbook.sheetnames
+                    'sheet_count': len(sheet_names),
+                    'sheet_names': sheet_names
                 },
                 'sheets_summary': {},
                 'ai_prompt': ""
             }
             
             # 分析每个工作表
-            for sheet_name in self.workbook.sheetnames:
+            for sheet_name in sheet_names:
                 sheet_summary = self._quick_analyze_sheet(sheet_name)
                 analysis['sheets_summary'][sheet_name] = sheet_summary
             
@@ -1684,7 +1943,10 @@ class LightweightExcelAnalyzer:
     
     def _quick_analyze_sheet(self, sheet_name: str) -> Dict[str, Any]:
         """快速分析单个工作表"""
-        ws = self.workbook[sheet_name]
+        if self.stream_reader is not None:
+            ws = self.stream_reader.read_sheet(sheet_name)
+        else:
+            ws = self.workbook[sheet_name]
         
         # 基本信息
         basic_info = {
@@ -1868,9 +2130,9 @@ class LightweightExcelAnalyzer:
             field_name = str(cell.value).strip() if cell.value else f"列{col}"
             field_names.append(field_name)
         
-        # 获取样本数据
+        # 获取样本数据（只在前几十行中查找）
         sample_count = 0
-        for row in range(header_row + 1, ws.max_row + 1):
+        for row in range(header_row + 1, min(ws.max_row, _QUICK_SCAN_ROWS) + 1):
             if sample_count >= limit:
                 break
             
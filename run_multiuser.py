@@ -14,38 +14,55 @@ import subprocess
 import sys
 import argparse
 import os
-from pathlib import Path
+from importlib.util import find_spec
+from functools import lru_cache
+
+# 启动前需要检查的依赖包和文件
+REQUIRED_PACKAGES = ("streamlit", "pandas", "openai", "plotly", "numpy")
+REQUIRED_FILES = (
+    "app_enhanced_multiuser.py",
+    "user_session_manager.py",
+    "excel_utils.py",
+    "config_multiuser.py",
+    "requirements.txt",
+)
+
+@lru_cache(maxsize=None)
+def _has_module(module_name: str) -> bool:
+    """检查模块是否可导入（只查找，不实际导入）"""
+    return find_spec(module_name) is not None
 
 def check_dependencies():
     """检查依赖包是否已安装"""
-    try:
-        import streamlit
-        import pandas
-        import openai
-        import plotly
-        import numpy
-        print("✅ 所有依赖包已正确安装")
-        return True
-    except ImportError as e:
-        print(f"❌ 缺少依赖包: {e}")
+    missing_packages = [
+        name for name in REQUIRED_PACKAGES
+        if not _has_module(name)
+    ]
+    
+    if missing_packages:
+        print(f"❌ 缺少依赖包: {', '.join(missing_packages)}")
         print("📦 请运行以下命令安装依赖:")
         print("   pip install -r requirements.txt")
         return False
+    
+    print("✅ 所有依赖包已正确安装")
+    return True
 
 def check_files():
     """检查必要文件是否存在"""
-    required_files = [
-        "app_enhanced_multiuser.py",
-        "user_session_manager.py", 
-        "excel_utils.py",
-        "config_multiuser.py",
-        "requirements.txt"
-    ]
+    # 每个目录只列举一次，避免逐个文件stat
+    dir_entries = {}
+    for parent in {os.path.dirname(file) or "." for file in REQUIRED_FILES}:
+        try:
+            with os.scandir(parent) as it:
+                dir_entries[parent] = {entry.name for entry in it}
+        except OSError:
+            dir_entries[parent] = set()
     
-    missing_files = []
-    for file in required_files:
-        if not Path(file).exists():
-            missing_files.append(file)
+    missing_files = [
+        file for file in REQUIRED_FILES
+        if os.path.basename(file) not in dir_entries[os.path.dirname(file) or "."]
+    ]
     
     if missing_files:
         print(f"❌ 缺少必要文件: {', '.join(missing_files)}")
@@ -96,9 +113,18 @@ def main():
     
     try:
         # 启动Streamlit应用
-        subprocess.run(cmd)
-    except KeyboardInterrupt:
-        print("\n👋 应用已停止")
+        if os.name == "posix":
+            # 用Streamlit进程替换当前启动器进程，不再常驻一个等待中的Python进程，Ctrl-C也直接交给Streamlit
+            # execv不会刷新Python的输出缓冲，输出重定向到文件时需先手动刷新，否则上面的提示信息会丢失
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execv(sys.executable, cmd)
+        else:
+            # Windows上的exec只是模拟替换进程，继续使用子进程方式
+            try:
+                subprocess.run(cmd)
+            except KeyboardInterrupt:
+                print("\n👋 应用已停止")
     except Exception as e:
         print(f"❌ 启动失败: {e}")
         sys.exit(1)
@@ -4,19 +4,76 @@ AI Excel 智能分析工具 - 用户会话管理器
 """
 
 import os
+import re
 import uuid
 import json
 import hashlib
 import tempfile
 import shutil
+import tarfile
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 import threading
 import time
 import atexit
 import logging
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    # orjson不可用时使用标准库json
+    orjson = None
+
+# 跨进程文件锁：Linux/macOS使用fcntl，Windows使用msvcrt
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+# 支持的Excel文件扩展名
+EXCEL_EXTENSIONS = frozenset({'.xlsx', '.xls', '.xlsm', '.xlsb'})
+
+# 文件名中不允许的字符
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\s\-\._]')
+
+# 上传文件名的时间戳前缀，格式：20241201_123456_原始文件名.xlsx
+_TIMESTAMP_PREFIX_RE = re.compile(r'^\d{8}_\d{6}_(.+)$')
+
+# 文件扩展名对应的文件类型
+_EXT_FILE_TYPES = {
+    **{ext: "Excel" for ext in EXCEL_EXTENSIONS},
+    '.csv': "CSV",
+    '.txt': "文本",
+    '.pdf': "PDF",
+    '.doc': "Word",
+    '.docx': "Word",
+}
+
+def _read_json_file(file_path) -> Any:
+    """读取JSON文件（优先使用orjson）"""
+    if orjson is not None:
+        with open(file_path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json_file(file_path, data: Any):
+    """写入带缩进的UTF-8 JSON文件（优先使用orjson）"""
+    if orjson is not None:
+        with open(file_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
 class UserSessionManager:
     """用户会话管理器"""
     
@@ -35,17 +92,61 @@ class UserSessionManager:
         self.session_timeout = timedelta(hours=session_timeout_hours)
         self.cleanup_interval = cleanup_interval_minutes * 60
         
+        # 活跃会话中的过期文件：临时文件直接删除，导出文件打包归档
+        self.temp_file_max_age_seconds = 3600
+        self.export_archive_age_seconds = 24 * 3600
+        
         # 创建基础目录
         self.base_upload_dir.mkdir(exist_ok=True)
         
-        # 会话信息存储
+        # 会话信息存储：每个会话一个文件，旧版sessions.json仅用于迁移
+        self.sessions_dir = self.base_upload_dir / "sessions"
+        self.sessions_dir.mkdir(exist_ok=True)
         self.sessions_file = self.base_upload_dir / "sessions.json"
-        self.sessions_lock = threading.Lock()
+        # 进程内使用线程锁，跨进程使用文件锁
+        self.sessions_lock = threading.RLock()
+        self.sessions_lock_file = self.base_upload_dir / "sessions.lock"
+        
+        # 会话信息内存缓存，修改后延迟写回磁盘
+        self.flush_delay_seconds = 5
+        self._sessions_cache: Dict[str, Any] = {}
+        self._sessions_fully_loaded = False
+        self._dirty_sessions = set()
+        # 本实例尚未写回的增量修改：新建的会话和文件计数增量，写回时合并到磁盘上的最新记录
+        self._new_sessions = set()
+        self._pending_file_counts: Dict[str, int] = {}
+        self._flush_timer: Optional[threading.Timer] = None
+        
+        # 最后访问时间的更新间隔，间隔内的重复访问不再记录
+        self.access_update_interval_seconds = 60
+        self._last_access_written: Dict[str, float] = {}
+        
+        # 按秒缓存的时间戳字符串（秒, 'YYYYmmdd_HHMMSS'）
+        self._timestamp_cache = (0, "")
+        
+        # 磁盘使用量缓存（字节数, 计算时间）
+        self.disk_usage_ttl_seconds = 30
+        self._disk_usage_cache = (0, 0.0)
+        
+        # 用户工作空间路径缓存 {会话ID: 路径}
+        self._workspace_paths: Dict[str, Path] = {}
+        
+        # 按文件名查找的结果缓存 {(会话ID, 文件名): (上传目录mtime, 文件路径)}
+        self._file_lookup_cache: Dict[Tuple[str, str], Tuple[float, Path]] = {}
+        
+        # 上传目录扫描结果缓存 {会话ID: (扫描时间, 文件信息列表)}
+        self.uploads_cache_ttl_seconds = 5
+        self._uploads_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
         
         # 初始化日志
         self.logger = logging.getLogger(__name__)
         
+        self._migrate_legacy_sessions_file()
+        
         # 启动清理任务
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._cleanup_thread: Optional[threading.Thread] = None
         self._start_cleanup_task()
         
         # 注册程序退出时的清理
@@ -63,14 +164,13 @@ class UserSessionManager:
         """
         if identifier:
             # 基于标识符生成更稳定的会话ID
-            hash_object = hashlib.md5(f"{identifier}_{datetime.now().strftime('%Y%m%d')}".encode())
-            base_id = hash_object.hexdigest()[:16]
+            base_id = hashlib.blake2b(f"{identifier}_{self._now_stamp()[:8]}".encode(), digest_size=8).hexdigest()
         else:
             # 生成随机会话ID
             base_id = str(uuid.uuid4()).replace('-', '')[:16]
         
         # 确保唯一性
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        timestamp = self._now_stamp().replace('_', '')
         return f"user_{base_id}_{timestamp}"
     
     def create_user_workspace(self, session_id: str) -> Path:
@@ -101,6 +201,37 @@ class UserSessionManager:
         
         return user_dir
     
+    def ensure_user_workspace(self, session_id: str) -> Path:
+        """
+        获取用户工作空间，不存在时创建（只更新一次会话记录）
+        
+        Args:
+            session_id: 用户会话ID
+        
+        Returns:
+            用户工作空间路径
+        """
+        user_dir = self.base_upload_dir / session_id
+        # 目录不存在说明会话已被清理（可能是其他实例），本实例缓存的会话记录已过期
+        workspace_existed = os.path.isdir(user_dir)
+        for sub_dir in ("uploads", "exports", "temp"):
+            (user_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+        
+        now = datetime.now().isoformat()
+        with self.sessions_lock:
+            if workspace_existed and self._get_cached_session(session_id) is not None:
+                self._update_session_access(session_id)
+            else:
+                self._sessions_cache.pop(session_id, None)
+                self._update_session_info(session_id, {
+                    'created_at': now,
+                    'last_access': now,
+                    'workspace_path': str(user_dir),
+                    'file_count': 0
+                })
+        
+        return user_dir
+    
     def get_user_workspace(self, session_id: str) -> Optional[Path]:
         """
         获取用户工作空间路径
@@ -111,8 +242,11 @@ class UserSessionManager:
         Returns:
             用户工作空间路径，如果不存在则返回None
         """
-        user_dir = self.base_upload_dir / session_id
-        if user_dir.exists():
+        user_dir = self._workspace_paths.get(session_id)
+        if user_dir is None:
+            user_dir = self.base_upload_dir / session_id
+            self._workspace_paths[session_id] = user_dir
+        if os.path.isdir(user_dir):
             # 更新最后访问时间
             self._update_session_access(session_id)
             return user_dir
@@ -131,23 +265,31 @@ class UserSessionManager:
             保存的文件路径
         """
         # 获取或创建用户工作空间
-        workspace = self.get_user_workspace(session_id)
-        if not workspace:
-            workspace = self.create_user_workspace(session_id)
+        workspace = self.ensure_user_workspace(session_id)
         
         # 生成安全的文件名
         if not filename:
             filename = uploaded_file.name
         
         safe_filename = self._sanitize_filename(filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        timestamp = self._now_stamp()
         unique_filename = f"{timestamp}_{safe_filename}"
         
         file_path = workspace / "uploads" / unique_filename
         
-        # 保存文件
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.read())
+        # 保存文件（分块写入，避免整个文件在内存中再复制一份）
+        if hasattr(uploaded_file, "seek"):
+            uploaded_file.seek(0)
+        with open(file_path, "wb", buffering=0) as f:
+            shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
+            saved_size = f.tell()
+        
+        # 增量更新磁盘使用量缓存
+        cached_size, cached_at = self._disk_usage_cache
+        self._disk_usage_cache = (cached_size + saved_size, cached_at)
+        
+        # 上传目录已变化，文件列表缓存失效
+        self._uploads_cache.pop(session_id, None)
         
         # 更新会话信息
         self._increment_file_count(session_id)
@@ -166,12 +308,10 @@ class UserSessionManager:
         Returns:
             导出文件路径
         """
-        workspace = self.get_user_workspace(session_id)
-        if not workspace:
-            workspace = self.create_user_workspace(session_id)
+        workspace = self.ensure_user_workspace(session_id)
         
         safe_filename = self._sanitize_filename(filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        timestamp = self._now_stamp()
         export_filename = f"{timestamp}_{safe_filename}"
         
         return workspace / "exports" / export_filename
@@ -187,9 +327,7 @@ class UserSessionManager:
         Returns:
             临时文件路径
         """
-        workspace = self.get_user_workspace(session_id)
-        if not workspace:
-            workspace = self.create_user_workspace(session_id)
+        workspace = self.ensure_user_workspace(session_id)
         
         if filename:
             safe_filename = self._sanitize_filename(filename)
@@ -199,16 +337,21 @@ class UserSessionManager:
             temp_filename = f"temp_{uuid.uuid4().hex[:8]}.tmp"
             return workspace / "temp" / temp_filename
     
-    def get_user_excel_files(self, session_id: str) -> List[Dict[str, Any]]:
+    def _scan_uploads(self, session_id: str) -> List[Dict[str, Any]]:
         """
-        获取用户已上传的Excel文件列表
+        扫描用户上传目录，结果在内存中缓存若干秒
         
         Args:
             session_id: 用户会话ID
         
         Returns:
-            Excel文件信息列表，包含文件名、路径、上传时间等
+            文件信息列表（按修改时间倒序），失败时返回空列表
         """
+        now = time.monotonic()
+        cached_at, cached = self._uploads_cache.get(session_id, (0.0, None))
+        if cached is not None and now - cached_at < self.uploads_cache_ttl_seconds:
+            return cached
+        
         workspace = self.get_user_workspace(session_id)
         if not workspace:
             return []
@@ -217,41 +360,56 @@ class UserSessionManager:
         if not uploads_dir.exists():
             return []
         
-        excel_files = []
-        excel_extensions = ['.xlsx', '.xls', '.xlsm', '.xlsb']
+        files = []
         
         try:
-            for file_path in uploads_dir.iterdir():
-                if file_path.is_file() and file_path.suffix.lower() in excel_extensions:
-                    stat_info = file_path.stat()
-                    
-                    # 解析文件名中的时间戳（如果存在）
-                    filename = file_path.name
-                    display_name = filename
+            with os.scandir(uploads_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat_info = entry.stat()
                     
                     # 如果文件名包含时间戳前缀，提取原始文件名
-                    if '_' in filename and len(filename.split('_')[0]) == 15:
-                        # 格式：20241201_123456_原始文件名.xlsx
-                        parts = filename.split('_', 2)
-                        if len(parts) >= 3:
-                            display_name = parts[2]
+                    filename = entry.name
+                    match = _TIMESTAMP_PREFIX_RE.match(filename)
+                    display_name = match.group(1) if match else filename
                     
-                    excel_files.append({
+                    # 确定文件类型
+                    ext = os.path.splitext(filename)[1].lower()
+                    
+                    files.append({
                         'filename': filename,  # 实际文件名
                         'display_name': display_name,  # 显示名称
-                        'path': str(file_path),
+                        'path': entry.path,
+                        'type': _EXT_FILE_TYPES.get(ext, "其他"),
+                        'ext': ext,
                         'size': stat_info.st_size,
                         'modified_time': datetime.fromtimestamp(stat_info.st_mtime),
                         'size_mb': round(stat_info.st_size / (1024 * 1024), 2)
                     })
             
             # 按修改时间排序，最新的在前
-            excel_files.sort(key=lambda x: x['modified_time'], reverse=True)
+            files.sort(key=itemgetter('modified_time'), reverse=True)
             
         except Exception as e:
-            self.logger.error(f"获取Excel文件列表失败 {session_id}: {e}")
+            self.logger.error(f"获取用户文件列表失败 {session_id}: {e}")
+            return []
+        
+        self._uploads_cache[session_id] = (now, files)
+        return files
+    
+    def get_user_excel_files(self, session_id: str) -> List[Dict[str, Any]]:
+        """
+        获取用户已上传的Excel文件列表
+        
+        Args:
+            session_id: 用户会话ID
         
-        return excel_files
+        Returns:
+            Excel文件信息列表，包含文件名、路径、上传时间等
+        """
+        return [dict(info) for info in self._scan_uploads(session_id)
+                if info['ext'] in EXCEL_EXTENSIONS]
     
     def get_user_file_by_name(self, session_id: str, filename: str) -> Optional[Path]:
         """
@@ -269,13 +427,22 @@ class UserSessionManager:
             return None
         
         uploads_dir = workspace / "uploads"
-        if not uploads_dir.exists():
+        try:
+            uploads_mtime = os.stat(uploads_dir).st_mtime
+        except OSError:
             return None
         
+        # 上传目录未变化时直接复用上次的查找结果
+        cache_key = (session_id, filename)
+        cached = self._file_lookup_cache.get(cache_key)
+        if cached is not None and cached[0] == uploads_mtime:
+            return cached[1]
+        
         try:
             # 首先尝试直接匹配文件名
             direct_path = uploads_dir / filename
             if direct_path.exists():
+                self._file_lookup_cache[cache_key] = (uploads_mtime, direct_path)
                 return direct_path
             
             # 如果直接匹配失败，搜索所有文件
@@ -283,14 +450,14 @@ class UserSessionManager:
                 if file_path.is_file():
                     # 检查是否匹配实际文件名
                     if file_path.name == filename:
+                        self._file_lookup_cache[cache_key] = (uploads_mtime, file_path)
                         return file_path
                     
                     # 检查是否匹配显示名称（去除时间戳前缀）
-                    current_filename = file_path.name
-                    if '_' in current_filename and len(current_filename.split('_')[0]) == 15:
-                        parts = current_filename.split('_', 2)
-                        if len(parts) >= 3 and parts[2] == filename:
-                            return file_path
+                    match = _TIMESTAMP_PREFIX_RE.match(file_path.name)
+                    if match and match.group(1) == filename:
+                        self._file_lookup_cache[cache_key] = (uploads_mtime, file_path)
+                        return file_path
             
         except Exception as e:
             self.logger.error(f"查找用户文件失败 {session_id}: {e}")
@@ -307,61 +474,7 @@ class UserSessionManager:
         Returns:
             文件信息列表
         """
-        workspace = self.get_user_workspace(session_id)
-        if not workspace:
-            return []
-        
-        uploads_dir = workspace / "uploads"
-        if not uploads_dir.exists():
-            return []
-        
-        all_files = []
-        
-        try:
-            for file_path in uploads_dir.iterdir():
-                if file_path.is_file():
-                    stat_info = file_path.stat()
-                    
-                    filename = file_path.name
-                    display_name = filename
-                    file_type = "其他"
-                    
-                    # 解析文件名中的时间戳（如果存在）
-                    if '_' in filename and len(filename.split('_')[0]) == 15:
-                        parts = filename.split('_', 2)
-                        if len(parts) >= 3:
-                            display_name = parts[2]
-                    
-                    # 确定文件类型
-                    ext = file_path.suffix.lower()
-                    if ext in ['.xlsx', '.xls', '.xlsm', '.xlsb']:
-                        file_type = "Excel"
-                    elif ext in ['.csv']:
-                        file_type = "CSV"
-                    elif ext in ['.txt']:
-                        file_type = "文本"
-                    elif ext in ['.pdf']:
-                        file_type = "PDF"
-                    elif ext in ['.doc', '.docx']:
-                        file_type = "Word"
-                    
-                    all_files.append({
-                        'filename': filename,
-                        'display_name': display_name,
-                        'path': str(file_path),
-                        'type': file_type,
-                        'size': stat_info.st_size,
-                        'modified_time': datetime.fromtimestamp(stat_info.st_mtime),
-                        'size_mb': round(stat_info.st_size / (1024 * 1024), 2)
-                    })
-            
-            # 按修改时间排序，最新的在前
-            all_files.sort(key=lambda x: x['modified_time'], reverse=True)
-            
-        except Exception as e:
-            self.logger.error(f"获取用户文件列表失败 {session_id}: {e}")
-        
-        return all_files
+        return [dict(info) for info in self._scan_uploads(session_id)]
     
     def cleanup_user_session(self, session_id: str) -> bool:
         """
@@ -377,6 +490,13 @@ class UserSessionManager:
             user_dir = self.base_upload_dir / session_id
             if user_dir.exists():
                 shutil.rmtree(user_dir)
+                # 相关缓存失效（可能在多个清理线程中并发执行）
+                with self.sessions_lock:
+                    self._disk_usage_cache = (0, 0.0)
+                    for key in [k for k in self._file_lookup_cache if k[0] == session_id]:
+                        self._file_lookup_cache.pop(key, None)
+                    self._uploads_cache.pop(session_id, None)
+                    self._workspace_paths.pop(session_id, None)
                 self.logger.info(f"已清理用户会话: {session_id}")
             
             # 从会话记录中移除
@@ -394,21 +514,119 @@ class UserSessionManager:
         Returns:
             已清理的会话ID列表
         """
-        cleaned_sessions = []
-        sessions = self._load_sessions()
+        # 其他管理器实例可能刚更新过访问时间，判断过期前从磁盘刷新
+        sessions = self._load_sessions(refresh=True)
         current_time = datetime.now()
         
+        expired_sessions = []
         for session_id, session_info in sessions.items():
             try:
                 last_access = datetime.fromisoformat(session_info['last_access'])
                 if current_time - last_access > self.session_timeout:
-                    if self.cleanup_user_session(session_id):
-                        cleaned_sessions.append(session_id)
+                    expired_sessions.append(session_id)
                         
             except Exception as e:
                 self.logger.error(f"检查会话过期时出错 {session_id}: {e}")
         
-        return cleaned_sessions
+        if not expired_sessions:
+            return []
+        
+        # 删除目录以I/O为主，多个会话并行清理
+        with ThreadPoolExecutor(max_workers=min(8, len(expired_sessions))) as executor:
+            results = list(executor.map(self.cleanup_user_session, expired_sessions))
+        
+        return [session_id for session_id, ok in zip(expired_sessions, results) if ok]
+    
+    def compact_stale_files(self) -> int:
+        """
+        清理活跃会话中的过期文件：删除过期临时文件，将过期导出文件打包为tar.gz
+        
+        Returns:
+            删除或归档的文件数
+        """
+        now = time.time()
+        compacted = 0
+        
+        for session_id in self._load_sessions():
+            user_dir = self.base_upload_dir / session_id
+            if not os.path.isdir(user_dir):
+                continue
+            try:
+                compacted += self._remove_stale_temp_files(user_dir / "temp", now)
+                compacted += self._archive_stale_exports(user_dir / "exports", now)
+            except Exception as e:
+                self.logger.error(f"清理过期文件失败 {session_id}: {e}")
+        
+        if compacted:
+            # 磁盘使用量缓存失效，下次统计时重新计算
+            self._disk_usage_cache = (0, 0.0)
+        return compacted
+    
+    def _remove_stale_temp_files(self, temp_dir: Path, now: float) -> int:
+        """删除超过保留时间的临时文件"""
+        removed = 0
+        try:
+            with os.scandir(temp_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        if now - entry.stat().st_mtime > self.temp_file_max_age_seconds:
+                            os.unlink(entry.path)
+                            removed += 1
+                    except FileNotFoundError:
+                        # 文件可能在遍历期间被删除
+                        pass
+        except FileNotFoundError:
+            pass
+        return removed
+    
+    def _archive_stale_exports(self, exports_dir: Path, now: float) -> int:
+        """将超过保留时间的导出文件打包为当天的tar.gz归档，并删除原文件"""
+        archive_path = exports_dir / f"archive_{self._now_stamp()[:8]}.tar.gz"
+        if archive_path.exists():
+            # 当天已经归档过
+            return 0
+        
+        stale_files = []
+        try:
+            with os.scandir(exports_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False) or entry.name.endswith('.tar.gz'):
+                        continue
+                    try:
+                        if now - entry.stat().st_mtime > self.export_archive_age_seconds:
+                            stale_files.append((entry.path, entry.name))
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            return 0
+        
+        if not stale_files:
+            return 0
+        
+        # 先写临时文件再重命名，避免留下不完整的归档（每个实例使用独立的临时文件）
+        fd, tmp_path = tempfile.mkstemp(dir=exports_dir, prefix=".archive_", suffix=".tmp")
+        os.close(fd)
+        try:
+            with tarfile.open(tmp_path, 'w:gz', compresslevel=1) as tar:
+                for file_path, name in stale_files:
+                    tar.add(file_path, arcname=name)
+            os.replace(tmp_path, archive_path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        
+        for file_path, _ in stale_files:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                # 可能已被其他实例的清理任务删除
+                pass
+        return len(stale_files)
     
     def get_session_stats(self) -> Dict[str, Any]:
         """
@@ -417,26 +635,27 @@ class UserSessionManager:
         Returns:
             会话统计信息
         """
-        sessions = self._load_sessions()
+        sessions = self._load_sessions(refresh=True)
         total_sessions = len(sessions)
         
-        # 计算活跃会话数（24小时内活跃）
+        # 一次遍历统计活跃会话数（24小时内活跃）和总文件数
+        # last_access都是datetime.isoformat()格式，可以直接按字符串比较
         active_sessions = 0
-        current_time = datetime.now()
+        total_files = 0
+        cutoff = (datetime.now() - timedelta(hours=24)).isoformat()
         
         for session_info in sessions.values():
-            try:
-                last_access = datetime.fromisoformat(session_info['last_access'])
-                if current_time - last_access <= timedelta(hours=24):
-                    active_sessions += 1
-            except:
-                pass
-        
-        # 计算总文件数
-        total_files = sum(session_info.get('file_count', 0) for session_info in sessions.values())
-        
-        # 计算磁盘使用量
-        total_size = self._calculate_directory_size(self.base_upload_dir)
+            last_access = session_info.get('last_access')
+            if isinstance(last_access, str) and last_access >= cutoff:
+                active_sessions += 1
+            total_files += session_info.get('file_count', 0)
+        
+        # 计算磁盘使用量（短时间内复用缓存结果）
+        total_size, computed_at = self._disk_usage_cache
+        now = time.monotonic()
+        if not computed_at or now - computed_at >= self.disk_usage_ttl_seconds:
+            total_size = self._calculate_directory_size(self.base_upload_dir)
+            self._disk_usage_cache = (total_size, now)
         
         return {
             'total_sessions': total_sessions,
@@ -447,96 +666,309 @@ class UserSessionManager:
             'session_timeout_hours': self.session_timeout.total_seconds() / 3600
         }
     
+    def _now_stamp(self) -> str:
+        """当前本地时间的'YYYYmmdd_HHMMSS'字符串，同一秒内复用格式化结果"""
+        now = int(time.time())
+        cached_second, cached_stamp = self._timestamp_cache
+        if cached_second == now:
+            return cached_stamp
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(now))
+        self._timestamp_cache = (now, stamp)
+        return stamp
+    
     def _sanitize_filename(self, filename: str) -> str:
         """清理文件名，移除危险字符"""
-        import re
         # 移除危险字符
-        safe_name = re.sub(r'[^\w\s\-\._]', '', filename)
+        safe_name = _UNSAFE_FILENAME_RE.sub('', filename)
         # 限制长度
         if len(safe_name) > 100:
             name, ext = os.path.splitext(safe_name)
             safe_name = name[:95] + ext
         return safe_name
     
-    def _load_sessions(self) -> Dict[str, Any]:
-        """加载会话信息"""
-        with self.sessions_lock:
-            if self.sessions_file.exists():
+    @contextmanager
+    def _sessions_file_lock(self, shared: bool = False):
+        """
+        会话文件的跨进程锁（多个worker进程共享同一个会话目录时使用）
+        
+        Args:
+            shared: 是否为共享锁（仅读取时使用，Windows下始终为独占锁）
+        """
+        with open(self.sessions_lock_file, 'a+b') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
                 try:
-                    with open(self.sessions_file, 'r', encoding='utf-8') as f:
-                        return json.load(f)
-                except Exception as e:
-                    self.logger.error(f"加载会话信息失败: {e}")
-            return {}
-    
-    def _save_sessions(self, sessions: Dict[str, Any]):
-        """保存会话信息"""
-        with self.sessions_lock:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                lock_file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK重试约10秒后仍失败，继续等待
+                        continue
+                try:
+                    yield
+                finally:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                yield
+    
+    def _session_file(self, session_id: str) -> Path:
+        """会话信息文件路径"""
+        return self.sessions_dir / f"{session_id}.json"
+    
+    def _read_session_file(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """从磁盘读取单个会话信息"""
+        session_file = self._session_file(session_id)
+        try:
+            return _read_json_file(session_file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.error(f"加载会话信息失败 {session_id}: {e}")
+            return None
+    
+    def _read_all_session_files(self) -> Dict[str, Any]:
+        """从磁盘读取全部会话信息"""
+        sessions = {}
+        try:
+            with self._sessions_file_lock(shared=True), os.scandir(self.sessions_dir) as entries:
+                for entry in entries:
+                    session_id, ext = os.path.splitext(entry.name)
+                    if ext != '.json' or not entry.is_file(follow_symlinks=False):
+                        continue
+                    session_info = self._read_session_file(session_id)
+                    if session_info is not None:
+                        sessions[session_id] = session_info
+        except Exception as e:
+            self.logger.error(f"加载会话信息失败: {e}")
+        return sessions
+    
+    def _write_session_file(self, session_id: str, session_info: Dict[str, Any]):
+        """原子写入单个会话信息（先写临时文件再重命名）"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.sessions_dir, prefix=f".{session_id}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            _write_json_file(tmp_path, session_info)
+            os.replace(tmp_path, self._session_file(session_id))
+        except Exception as e:
+            self.logger.error(f"保存会话信息失败 {session_id}: {e}")
             try:
-                with open(self.sessions_file, 'w', encoding='utf-8') as f:
-                    json.dump(sessions, f, ensure_ascii=False, indent=2)
-            except Exception as e:
-                self.logger.error(f"保存会话信息失败: {e}")
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+    
+    def _delete_session_file(self, session_id: str):
+        """删除单个会话信息文件"""
+        try:
+            os.unlink(self._session_file(session_id))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error(f"删除会话信息失败 {session_id}: {e}")
+    
+    def _migrate_legacy_sessions_file(self):
+        """将旧版sessions.json拆分为每个会话一个文件"""
+        if not self.sessions_file.exists():
+            return
+        try:
+            with self._sessions_file_lock():
+                legacy_sessions = _read_json_file(self.sessions_file)
+                for session_id, session_info in legacy_sessions.items():
+                    if not self._session_file(session_id).exists():
+                        self._write_session_file(session_id, session_info)
+                self.sessions_file.unlink()
+            self.logger.info(f"已迁移 {len(legacy_sessions)} 个会话记录")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error(f"迁移会话信息失败: {e}")
+    
+    def _load_sessions(self, refresh: bool = False) -> Dict[str, Any]:
+        """
+        加载全部会话信息（优先使用内存缓存）
+        
+        Args:
+            refresh: 是否先写回本实例的修改并从磁盘重新加载
+        
+        Returns:
+            会话信息的浅拷贝
+        """
+        with self.sessions_lock:
+            if refresh or not self._sessions_fully_loaded:
+                # 先写回本实例未保存的修改，避免重新加载时丢失
+                self._flush_sessions()
+                self._sessions_cache = self._read_all_session_files()
+                self._sessions_fully_loaded = True
+            return dict(self._sessions_cache)
+    
+    def _get_cached_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        获取单个会话信息，未缓存时只读取该会话的文件
+        
+        缓存可能落后于其他实例的修改，只用于读取；修改需通过增量记录，在写回时合并
+        """
+        session_info = self._sessions_cache.get(session_id)
+        if session_info is None:
+            # 可能是其他实例创建的会话
+            session_info = self._read_session_file(session_id)
+            if session_info is not None:
+                self._sessions_cache[session_id] = session_info
+        return session_info
+    
+    def _flush_sessions(self):
+        """
+        将本实例修改过的会话写回磁盘（只写被修改的会话文件）
+        
+        其他实例可能在此期间更新过同一会话，因此在跨进程锁内重新读取会话文件，
+        再把本实例的修改合并上去：文件计数累加增量，最后访问时间取较新者。
+        """
+        with self.sessions_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            
+            if not self._dirty_sessions:
+                return
+            
+            with self._sessions_file_lock():
+                for session_id in self._dirty_sessions:
+                    cached_info = self._sessions_cache.get(session_id)
+                    if cached_info is None:
+                        self._delete_session_file(session_id)
+                        continue
+                    
+                    disk_info = self._read_session_file(session_id)
+                    if disk_info is None:
+                        if session_id not in self._new_sessions:
+                            # 会话已被其他实例清理，不再重新创建
+                            self._sessions_cache.pop(session_id, None)
+                            continue
+                        merged_info = dict(cached_info)
+                    else:
+                        merged_info = disk_info
+                        merged_info['last_access'] = max(disk_info.get('last_access', ''),
+                                                         cached_info.get('last_access', ''))
+                        merged_info['file_count'] = (disk_info.get('file_count', 0)
+                                                     + self._pending_file_counts.get(session_id, 0))
+                    
+                    self._write_session_file(session_id, merged_info)
+                    self._sessions_cache[session_id] = merged_info
+            
+            self._dirty_sessions.clear()
+            self._new_sessions.clear()
+            self._pending_file_counts.clear()
+    
+    def _mark_session_dirty(self, session_id: str):
+        """标记会话已修改，并安排延迟写回"""
+        self._dirty_sessions.add(session_id)
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay_seconds, self._flush_sessions)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
     
     def _update_session_info(self, session_id: str, info: Dict[str, Any]):
         """更新会话信息"""
-        sessions = self._load_sessions()
-        sessions[session_id] = info
-        self._save_sessions(sessions)
+        with self.sessions_lock:
+            self._sessions_cache[session_id] = info
+            self._new_sessions.add(session_id)
+            self._last_access_written[session_id] = time.monotonic()
+            self._mark_session_dirty(session_id)
     
     def _update_session_access(self, session_id: str):
         """更新会话最后访问时间"""
-        sessions = self._load_sessions()
-        if session_id in sessions:
-            sessions[session_id]['last_access'] = datetime.now().isoformat()
-            self._save_sessions(sessions)
+        now = time.monotonic()
+        with self.sessions_lock:
+            if now - self._last_access_written.get(session_id, float('-inf')) < self.access_update_interval_seconds:
+                return
+            session_info = self._get_cached_session(session_id)
+            if session_info is not None:
+                session_info['last_access'] = datetime.now().isoformat()
+                self._last_access_written[session_id] = now
+                self._mark_session_dirty(session_id)
     
     def _increment_file_count(self, session_id: str):
-        """增加会话文件计数"""
-        sessions = self._load_sessions()
-        if session_id in sessions:
-            sessions[session_id]['file_count'] = sessions[session_id].get('file_count', 0) + 1
-            self._save_sessions(sessions)
+        """增加会话文件计数（同时记录增量，写回时累加到磁盘上的计数）"""
+        with self.sessions_lock:
+            session_info = self._get_cached_session(session_id)
+            if session_info is not None:
+                session_info['file_count'] = session_info.get('file_count', 0) + 1
+                self._pending_file_counts[session_id] = self._pending_file_counts.get(session_id, 0) + 1
+                self._mark_session_dirty(session_id)
     
     def _remove_session_info(self, session_id: str):
         """从会话记录中移除"""
-        sessions = self._load_sessions()
-        if session_id in sessions:
-            del sessions[session_id]
-            self._save_sessions(sessions)
+        with self.sessions_lock:
+            self._sessions_cache.pop(session_id, None)
+            self._last_access_written.pop(session_id, None)
+            self._new_sessions.discard(session_id)
+            self._pending_file_counts.pop(session_id, None)
+            self._mark_session_dirty(session_id)
     
     def _calculate_directory_size(self, directory: Path) -> int:
         """计算目录大小（字节）"""
         total_size = 0
-        try:
-            for file_path in directory.rglob('*'):
-                if file_path.is_file():
-                    total_size += file_path.stat().st_size
-        except Exception as e:
-            self.logger.error(f"计算目录大小失败: {e}")
+        pending_dirs = [str(directory)]
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            try:
+                with os.scandir(current_dir) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending_dirs.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                total_size += entry.stat(follow_symlinks=False).st_size
+                        except OSError:
+                            # 文件可能在遍历期间被删除
+                            pass
+            except OSError as e:
+                self.logger.error(f"计算目录大小失败 {current_dir}: {e}")
         return total_size
     
     def _cleanup_task(self):
-        """定期清理任务"""
-        while True:
+        """定期清理任务（可被提前唤醒或停止）"""
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.cleanup_interval)
+            self._wake_event.clear()
+            if self._stop_event.is_set():
+                break
+            
             try:
-                time.sleep(self.cleanup_interval)
                 cleaned = self.cleanup_expired_sessions()
                 if cleaned:
                     self.logger.info(f"定期清理完成，清理了 {len(cleaned)} 个过期会话")
+                compacted = self.compact_stale_files()
+                if compacted:
+                    self.logger.info(f"已清理或归档 {compacted} 个过期文件")
+                self._flush_sessions()
                     
             except Exception as e:
                 self.logger.error(f"定期清理任务出错: {e}")
     
     def _start_cleanup_task(self):
         """启动后台清理任务"""
-        cleanup_thread = threading.Thread(target=self._cleanup_task, daemon=True)
-        cleanup_thread.start()
+        self._cleanup_thread = threading.Thread(target=self._cleanup_task, daemon=True)
+        self._cleanup_thread.start()
         self.logger.info("后台清理任务已启动")
     
+    def trigger_cleanup(self):
+        """立即唤醒后台清理任务执行一次清理"""
+        self._wake_event.set()
+    
     def cleanup_on_exit(self):
         """程序退出时的清理"""
         self.logger.info("程序退出，执行最终清理...")
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._cleanup_thread is not None and self._cleanup_thread is not threading.current_thread():
+            self._cleanup_thread.join(timeout=5)
+        self._flush_sessions()
 
 
 class UserConfigManager:
@@ -558,17 +990,14 @@ class UserConfigManager:
             是否保存成功
         """
         try:
-            workspace = self.session_manager.get_user_workspace(session_id)
-            if not workspace:
-                workspace = self.session_manager.create_user_workspace(session_id)
+            workspace = self.session_manager.ensure_user_workspace(session_id)
             
             config_file = workspace / "user_config.json"
             
             # 添加时间戳
             config['last_updated'] = datetime.now().isoformat()
             
-            with open(config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
+            _write_json_file(config_file, config)
             
             self.logger.info(f"用户配置已保存: {session_id}")
             return True
@@ -594,9 +1023,7 @@ class UserConfigManager:
             
             config_file = workspace / "user_config.json"
             if config_file.exists():
-                with open(config_file, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                return config
+                return _read_json_file(config_file)
             
             return None
             
@@ -645,15 +1072,12 @@ class UserConfigManager:
             是否保存成功
         """
         try:
-            workspace = self.session_manager.get_user_workspace(session_id)
-            if not workspace:
-                workspace = self.session_manager.create_user_workspace(session_id)
+            workspace = self.session_manager.ensure_user_workspace(session_id)
             
             cache_file = workspace / "browser_cache.json"
             safe_config = self.get_config_for_browser_cache(config)
             
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(safe_config, f, ensure_ascii=False, indent=2)
+            _write_json_file(cache_file, safe_config)
             
             self.logger.info(f"浏览器缓存配置已保存: {session_id}")
             return True
@@ -679,9 +1103,7 @@ class UserConfigManager:
             
             cache_file = workspace / "browser_cache.json"
             if cache_file.exists():
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_config = json.load(f)
-                return cache_config
+                return _read_json_file(cache_file)
             
             return None
             